@@ -1,18 +1,40 @@
 
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, flash, session
+from flask import Flask, Response, request, render_template_string, redirect, url_for, flash, session, send_file, g
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import secure_filename
 from functools import wraps
 from telethon import TelegramClient
 from telethon.sessions import StringSession
+from telethon.errors import SessionPasswordNeededError, PhoneCodeExpiredError
 import asyncio
 import os
+import sys
+import signal
 import json
 import uuid
+import time
+import shutil
+import hashlib
+import gzip
+import threading
+import contextlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///users.db')
@@ -233,14 +255,466 @@ async def create_client(operator_name, account_name=None):
         raise ValueError("TELEGRAM_API_ID и TELEGRAM_API_HASH должны быть установлены")
     
     session_file = get_session_file(operator_name, account_name)
-    client_key = f"{operator_name}_{account_name}" if account_name else operator_name
-    
+    return pool_client(get_client_key(operator_name, account_name), session_file)
+
+def get_client_key(operator_name, account_name=None):
+    """Ключ клиента в пуле; совпадает с именем файла сессии без расширения"""
+    return f"{operator_name}_{account_name}" if account_name else operator_name
+
+def pool_client(client_key, session_file):
+    """Получить клиент из пула, создав его при необходимости"""
     if client_key not in clients:
         client = TelegramClient(session_file, API_ID, API_HASH)
         clients[client_key] = client
     
     return clients[client_key]
 
+async def ensure_connected(client):
+    """Подключить клиент, если соединение еще не установлено"""
+    if not client.is_connected():
+        await client.connect()
+
+# Общий цикл событий для клиентов Telegram: соединения переживают отдельные HTTP-запросы
+telegram_loop = asyncio.new_event_loop()
+threading.Thread(target=telegram_loop.run_forever, name='telegram-loop', daemon=True).start()
+
+def run_telegram(coro):
+    """Выполнить корутину в общем цикле Telegram и дождаться результата"""
+    return asyncio.run_coroutine_threadsafe(coro, telegram_loop).result()
+
+# Планировщик вызовов Telegram
+ACCOUNT_CONCURRENCY = int(os.environ.get('TELEGRAM_ACCOUNT_CONCURRENCY', 4))
+BULK_HISTORY_LIMIT = 200
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+
+class AccountQueue:
+    """Очередь вызовов одного клиента Telegram"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = {priority: 0 for priority in PRIORITY_NAMES}
+        # Для каждого приоритета: запрашивающий -> очередь ожидающих future
+        self.waiting = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+    
+    def depth(self, priority=None):
+        priorities = PRIORITY_NAMES if priority is None else [priority]
+        return sum(
+            sum(not future.done() for future in futures)
+            for p in priorities for futures in self.waiting[p].values()
+        )
+    
+    def can_run(self, priority):
+        """Фоновым вызовам не отдаем последний слот, он остается для интерактивных"""
+        if sum(self.active.values()) >= self.limit:
+            return False
+        return priority == PRIORITY_INTERACTIVE or self.active[PRIORITY_BULK] < max(1, self.limit - 1)
+    
+    def pop_next(self):
+        """Следующий ожидающий: сначала по приоритету, затем по кругу между запрашивающими"""
+        for priority in sorted(PRIORITY_NAMES):
+            waiting = self.waiting[priority]
+            while waiting and self.can_run(priority):
+                requester, futures = waiting.popitem(last=False)
+                future = futures.popleft()
+                if futures:
+                    waiting[requester] = futures
+                if not future.done():
+                    return priority, future
+        return None, None
+
+class TelegramScheduler:
+    """Ограничивает параллельные вызовы на аккаунт и распределяет их справедливо"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self._queues = {}
+        self.wait_stats = {
+            name: {'calls': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, client_key, requester, priority):
+        queue = self._queues.setdefault(client_key, AccountQueue(self.limit))
+        started = time.monotonic()
+        
+        ahead = sum(queue.depth(p) for p in PRIORITY_NAMES if p <= priority)
+        if queue.can_run(priority) and not ahead:
+            queue.active[priority] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            queue.waiting[priority].setdefault(requester, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Слот мог быть выдан одновременно с отменой - возвращаем его
+                if future.done() and not future.cancelled():
+                    self._release(queue, priority)
+                raise
+        
+        self._record_wait(priority, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release(queue, priority)
+    
+    def _release(self, queue, priority):
+        queue.active[priority] -= 1
+        while True:
+            next_priority, future = queue.pop_next()
+            if future is None:
+                break
+            queue.active[next_priority] += 1
+            future.set_result(None)
+    
+    def _record_wait(self, priority, waited):
+        stats = self.wait_stats[PRIORITY_NAMES[priority]]
+        stats['calls'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+    
+    def snapshot(self):
+        """Глубина очередей и время ожидания по приоритетам"""
+        return {
+            'limit': self.limit,
+            'wait': {
+                name: dict(
+                    stats,
+                    wait_avg=stats['wait_total'] / stats['calls'] if stats['calls'] else 0.0
+                )
+                for name, stats in self.wait_stats.items()
+            },
+            'accounts': {
+                client_key: {
+                    'active': {PRIORITY_NAMES[p]: n for p, n in queue.active.items()},
+                    'queued': {PRIORITY_NAMES[p]: queue.depth(p) for p in PRIORITY_NAMES}
+                }
+                for client_key, queue in self._queues.items()
+            }
+        }
+
+telegram_scheduler = TelegramScheduler(ACCOUNT_CONCURRENCY)
+
+def get_request_priority(default=PRIORITY_INTERACTIVE):
+    """Приоритет вызова; клиент может только понизить его параметром priority=bulk"""
+    if request.args.get('priority') == 'bulk':
+        return PRIORITY_BULK
+    return default
+
+def run_scheduled(operator_name, account, coro, priority=PRIORITY_INTERACTIVE):
+    """Выполнить вызов Telegram через очередь аккаунта"""
+    # Справедливость считается между пользователями панели, общими для одного аккаунта
+    requester = current_user.get_id() if current_user.is_authenticated else request.remote_addr
+    client_key = get_client_key(operator_name, account)
+    
+    async def _scheduled():
+        async with telegram_scheduler.slot(client_key, requester, priority):
+            return await coro
+    
+    return run_telegram(_scheduled())
+
+# Сессии входа в Telegram
+LOGIN_SESSION_TTL = 600
+CODE_RESEND_INTERVAL = 60
+
+class LoginStepError(Exception):
+    """Шаг входа вызван не по порядку"""
+
+class LoginSession:
+    """Состояние многошагового входа для (оператор, аккаунт, телефон)"""
+    
+    CODE_SENT = 'code_sent'
+    PASSWORD_REQUIRED = 'password_required'
+    
+    def __init__(self, operator_name, account, phone):
+        self.operator_name = operator_name
+        self.account = account
+        self.phone = phone
+        self.state = None
+        self.phone_code_hash = None
+        self.resend_after = 0
+        self.lock = asyncio.Lock()
+        self.touch()
+    
+    def touch(self):
+        """Продлить время жизни сессии входа"""
+        self.expires_at = time.monotonic() + LOGIN_SESSION_TTL
+    
+    def code_sent(self, phone_code_hash, timeout=None):
+        """Запомнить отправленный код и окно, в течение которого повторно его не запрашиваем"""
+        self.state = self.CODE_SENT
+        self.phone_code_hash = phone_code_hash
+        self.resend_after = time.monotonic() + (timeout or CODE_RESEND_INTERVAL)
+        self.touch()
+
+# Доступ к сессиям входа только из цикла telegram_loop, поэтому без блокировок
+login_sessions = {}
+
+def get_login_session(operator_name, account, phone=None, create=False):
+    """Найти активную сессию входа; без телефона - единственную для аккаунта"""
+    now = time.monotonic()
+    for key in [k for k, login in login_sessions.items() if login.expires_at <= now]:
+        del login_sessions[key]
+    
+    if phone:
+        key = (operator_name, account, phone)
+        if create and key not in login_sessions:
+            login_sessions[key] = LoginSession(operator_name, account, phone)
+        return login_sessions.get(key)
+    
+    matches = [login for key, login in login_sessions.items() if key[:2] == (operator_name, account)]
+    return matches[0] if len(matches) == 1 else None
+
+# Сериализация ответов API
+COMPRESS_MIN_BYTES = 1024
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps_json(payload):
+    """Компактный JSON в байтах; orjson используется, если установлен"""
+    if orjson:
+        return orjson.dumps(payload)
+    return json.dumps(
+        payload, ensure_ascii=False, separators=(',', ':'), default=_json_default
+    ).encode('utf-8')
+
+def compress_body(body, encoding):
+    """Сжать тело ответа выбранным алгоритмом"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=4)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+def choose_encoding(body_size):
+    """Выбрать сжатие по заголовку Accept-Encoding"""
+    if body_size < COMPRESS_MIN_BYTES:
+        return None
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+class JSONSnapshot:
+    """Заранее сериализованный ответ; сжатые варианты вычисляются один раз"""
+    
+    def __init__(self, payload):
+        self.is_error = 'error' in payload
+        self.body = dumps_json(payload)
+        self._encoded = {}
+    
+    def encoded(self, encoding):
+        if encoding not in self._encoded:
+            self._encoded[encoding] = compress_body(self.body, encoding)
+        return self._encoded[encoding]
+
+def json_response(payload, status=200):
+    """Ответ API в JSON со сжатием, если клиент его поддерживает"""
+    snapshot = payload if isinstance(payload, JSONSnapshot) else JSONSnapshot(payload)
+    encoding = choose_encoding(len(snapshot.body))
+    response = Response(
+        snapshot.encoded(encoding) if encoding else snapshot.body,
+        status=status,
+        mimetype='application/json'
+    )
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+# Объединение одинаковых параллельных запросов к Telegram (single-flight)
+READ_CACHE_TTL = float(os.environ.get('TELEGRAM_READ_CACHE_TTL', 0))
+
+def is_error_result(result):
+    if isinstance(result, JSONSnapshot):
+        return result.is_error
+    return isinstance(result, dict) and 'error' in result
+
+class SingleFlight:
+    """Одинаковые одновременные вызовы выполняются один раз и получают общий результат"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = {}
+        # Поколение данных аккаунта растет при каждом invalidate()
+        self._generations = {}
+    
+    def do(self, key, fn, ttl=0):
+        """Выполнить fn() для ключа key либо дождаться уже идущего вызова"""
+        with self._lock:
+            cached = self._results.get(key)
+            if cached:
+                if cached[0] > time.monotonic():
+                    return cached[1]
+                del self._results[key]
+            
+            # Вызовы, начатые до invalidate(), не разделяются с новыми запросами
+            generation = self._generations.get(key[:2], 0)
+            call_key = (key, generation)
+            future = self._calls.get(call_key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[call_key] = future
+        
+        if not is_leader:
+            return future.result()
+        
+        try:
+            result = fn()
+        except Exception as e:
+            with self._lock:
+                del self._calls[call_key]
+            future.set_exception(e)
+            raise
+        
+        with self._lock:
+            del self._calls[call_key]
+            # Ошибки и результаты, устаревшие за время выполнения, не кэшируем
+            is_current = self._generations.get(key[:2], 0) == generation
+            if ttl > 0 and is_current and not is_error_result(result):
+                now = time.monotonic()
+                for expired in [k for k, (expires, _) in self._results.items() if expires <= now]:
+                    del self._results[expired]
+                self._results[key] = (now + ttl, result)
+        future.set_result(result)
+        return result
+    
+    def invalidate(self, operator_name, account):
+        """Сбросить кэшированные результаты чтения для аккаунта оператора"""
+        with self._lock:
+            account_key = (operator_name, account)
+            self._generations[account_key] = self._generations.get(account_key, 0) + 1
+            for key in [k for k in self._results if k[:2] == account_key]:
+                del self._results[key]
+
+telegram_reads = SingleFlight()
+
+# Дисковый кэш медиафайлов
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', 'media_cache')
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+UPLOAD_PART_SIZE_KB = 512
+
+class MediaCache:
+    """Кэш с адресацией по содержимому (sha256) и вытеснением давно не используемых файлов"""
+    
+    def __init__(self, root, max_bytes):
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, 'objects')
+        self.refs_dir = os.path.join(root, 'refs')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for directory in (self.objects_dir, self.refs_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+    
+    def _ref_path(self, media_key):
+        name = hashlib.sha1(repr(media_key).encode('utf-8')).hexdigest()
+        return os.path.join(self.refs_dir, name)
+    
+    def lookup(self, media_key):
+        """Вернуть описание закэшированного файла или None"""
+        try:
+            with open(self._ref_path(media_key), encoding='utf-8') as f:
+                ref = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        
+        path = os.path.join(self.objects_dir, ref['digest'])
+        try:
+            # Время изменения служит отметкой последнего использования для LRU
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return dict(ref, path=path)
+    
+    def new_temp_dir(self):
+        """Создать временный каталог для загружаемого файла"""
+        path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        os.makedirs(path)
+        return path
+    
+    def store(self, media_key, tmp_path, mime_type=None, file_name=None):
+        """Переместить загруженный файл в кэш и вернуть его описание"""
+        digest = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        path = os.path.join(self.objects_dir, digest)
+        ref = {'digest': digest, 'mime_type': mime_type, 'file_name': file_name}
+        
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                os.utime(path)
+            else:
+                os.replace(tmp_path, path)
+            
+            ref_path = self._ref_path(media_key)
+            with open(ref_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(ref, f)
+            os.replace(ref_path + '.tmp', ref_path)
+            
+            self._evict(keep=path)
+        
+        return dict(ref, path=path)
+    
+    def _evict(self, keep):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.objects_dir):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        
+        # Ссылки на удаленные файлы отбрасываются при следующем lookup
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+def get_media_type(message):
+    """Определить тип вложения сообщения"""
+    for media_type in ('photo', 'sticker', 'gif', 'voice', 'video_note', 'video', 'audio', 'document'):
+        if getattr(message, media_type, None):
+            return media_type
+    return None
+
+def describe_media(message, operator_name, account, chat_id):
+    """Метаданные вложения сообщения со ссылками на файл и миниатюру"""
+    media_type = get_media_type(message)
+    if not media_type:
+        return None
+    
+    file = message.file
+    url = f"/api/media/{operator_name}/{chat_id}/{message.id}?account={account}"
+    has_thumb = bool(message.photo) or bool(getattr(message.document, 'thumbs', None))
+    
+    return {
+        'type': media_type,
+        'file_name': file.name,
+        'mime_type': file.mime_type,
+        'size': file.size,
+        'width': file.width,
+        'height': file.height,
+        'duration': file.duration,
+        'url': url,
+        'thumb_url': f"{url}&thumb=1" if has_thumb else None
+    }
+
 # API методы для Telegram
 @app.route('/api/send_code', methods=['POST'])
 def send_code():
@@ -251,26 +725,39 @@ def send_code():
         account = data.get('account', 'main')
         
         if not phone or not operator:
-            return jsonify({'error': 'Номер телефона и оператор обязательны'}), 400
+            return json_response({'error': 'Номер телефона и оператор обязательны'}, 400)
         
         async def _send_code():
-            client = await create_client(operator, account)
-            await client.connect()
-            
-            result = await client.send_code_request(phone)
-            phone_code_hash = result.phone_code_hash
-            
-            return {
-                'success': True,
-                'phone_code_hash': phone_code_hash,
-                'message': f'Код отправлен на номер {phone}'
-            }
+            login = get_login_session(operator, account, phone, create=True)
+            async with login.lock:
+                # Повторные нажатия в пределах окна не создают новых запросов к Telegram
+                resend_in = login.resend_after - time.monotonic()
+                if login.state == LoginSession.CODE_SENT and resend_in > 0:
+                    return {
+                        'success': True,
+                        'phone_code_hash': login.phone_code_hash,
+                        'resend_in': int(resend_in),
+                        'message': f'Код уже отправлен на номер {phone}'
+                    }
+                
+                client = await create_client(operator, account)
+                await ensure_connected(client)
+                
+                result = await client.send_code_request(phone)
+                login.code_sent(result.phone_code_hash, result.timeout)
+                
+                return {
+                    'success': True,
+                    'phone_code_hash': result.phone_code_hash,
+                    'resend_in': int(login.resend_after - time.monotonic()),
+                    'message': f'Код отправлен на номер {phone}'
+                }
         
-        result = asyncio.run(_send_code())
-        return jsonify(result)
+        result = run_scheduled(operator, account, _send_code())
+        return json_response(result)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/verify_code', methods=['POST'])
 def verify_code():
@@ -278,74 +765,107 @@ def verify_code():
         data = request.json
         phone = data.get('phone')
         code = data.get('code')
-        phone_code_hash = data.get('phone_code_hash')
         operator = data.get('operator')
         account = data.get('account', 'main')
         
-        if not all([phone, code, phone_code_hash, operator]):
-            return jsonify({'error': 'Все поля обязательны'}), 400
+        if not all([phone, code, operator]):
+            return json_response({'error': 'Все поля обязательны'}, 400)
         
         async def _verify_code():
-            client = await create_client(operator, account)
-            await client.connect()
+            login = get_login_session(operator, account, phone)
+            if not login:
+                if not data.get('phone_code_hash'):
+                    raise LoginStepError('Сначала запросите код подтверждения')
+                # Сессия пропала после перезапуска или по TTL - восстанавливаем ее из хэша браузера
+                login = get_login_session(operator, account, phone, create=True)
+                login.state = LoginSession.CODE_SENT
+                login.phone_code_hash = data['phone_code_hash']
             
-            try:
-                await client.sign_in(phone, code, phone_code_hash=phone_code_hash)
-                return {
-                    'success': True,
-                    'message': 'Авторизация успешна'
-                }
-            except Exception as e:
-                if 'Two-steps verification is enabled' in str(e):
+            async with login.lock:
+                if login.state != LoginSession.CODE_SENT:
+                    raise LoginStepError('Сначала запросите код подтверждения')
+                
+                client = await create_client(operator, account)
+                await ensure_connected(client)
+                
+                try:
+                    phone_code_hash = data.get('phone_code_hash') or login.phone_code_hash
+                    await client.sign_in(phone, code, phone_code_hash=phone_code_hash)
+                except SessionPasswordNeededError:
+                    login.state = LoginSession.PASSWORD_REQUIRED
+                    login.touch()
                     return {
                         'success': False,
                         'two_factor_required': True,
                         'message': 'Требуется двухфакторная аутентификация'
                     }
-                else:
-                    raise e
+                except PhoneCodeExpiredError:
+                    # Истекший код можно запросить заново без ожидания окна
+                    login.state = None
+                    raise
+                
+                login_sessions.pop((operator, account, phone), None)
+                return {
+                    'success': True,
+                    'message': 'Авторизация успешна'
+                }
         
-        result = asyncio.run(_verify_code())
-        return jsonify(result)
+        result = run_scheduled(operator, account, _verify_code())
+        return json_response(result)
         
+    except LoginStepError as e:
+        return json_response({'error': str(e)}, 409)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/verify_password', methods=['POST'])
 def verify_password():
     try:
         data = request.json
         password = data.get('password')
+        phone = data.get('phone')
         operator = data.get('operator')
         account = data.get('account', 'main')
         
         if not all([password, operator]):
-            return jsonify({'error': 'Пароль и оператор обязательны'}), 400
+            return json_response({'error': 'Пароль и оператор обязательны'}, 400)
         
         async def _verify_password():
-            client = await create_client(operator, account)
-            await client.connect()
+            login = get_login_session(operator, account, phone)
+            if not login:
+                raise LoginStepError('Сначала подтвердите код из Telegram')
             
-            await client.sign_in(password=password)
-            return {
-                'success': True,
-                'message': 'Двухфакторная аутентификация пройдена'
-            }
+            async with login.lock:
+                if login.state != LoginSession.PASSWORD_REQUIRED:
+                    raise LoginStepError('Сначала подтвердите код из Telegram')
+                
+                client = await create_client(operator, account)
+                await ensure_connected(client)
+                
+                await client.sign_in(password=password)
+                login_sessions.pop((operator, account, login.phone), None)
+                return {
+                    'success': True,
+                    'message': 'Двухфакторная аутентификация пройдена'
+                }
         
-        result = asyncio.run(_verify_password())
-        return jsonify(result)
+        result = run_scheduled(operator, account, _verify_password())
+        return json_response(result)
         
+    except LoginStepError as e:
+        return json_response({'error': str(e)}, 409)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/chats/<operator_name>')
 def get_chats(operator_name):
     try:
         account = request.args.get('account', 'main')
+        priority = get_request_priority()
         
         async def _get_chats():
             client = await create_client(operator_name, account)
-            await client.connect()
+            await ensure_connected(client)
             
             if not await client.is_user_authorized():
                 return {'error': 'Пользователь не авторизован'}
@@ -359,28 +879,34 @@ def get_chats(operator_name):
                     'unread_count': dialog.unread_count,
                     'last_message': {
                         'text': dialog.message.text if dialog.message else '',
-                        'date': dialog.message.date.isoformat() if dialog.message else None
+                        'date': dialog.message.date if dialog.message else None
                     }
                 }
                 chats.append(chat_info)
             
             return {'chats': chats}
         
-        result = asyncio.run(_get_chats())
-        return jsonify(result)
+        result = telegram_reads.do(
+            (operator_name, account, 'get_chats', ()),
+            lambda: JSONSnapshot(run_scheduled(operator_name, account, _get_chats(), priority)),
+            ttl=READ_CACHE_TTL
+        )
+        return json_response(result)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/chat_messages/<operator_name>/<int:chat_id>')
 def get_chat_messages(operator_name, chat_id):
     try:
         account = request.args.get('account', 'main')
         limit = int(request.args.get('limit', 50))
+        # Выгрузка длинной истории не должна задерживать интерактивные вызовы
+        priority = get_request_priority(PRIORITY_BULK if limit > BULK_HISTORY_LIMIT else PRIORITY_INTERACTIVE)
         
         async def _get_messages():
             client = await create_client(operator_name, account)
-            await client.connect()
+            await ensure_connected(client)
             
             if not await client.is_user_authorized():
                 return {'error': 'Пользователь не авторизован'}
@@ -390,51 +916,165 @@ def get_chat_messages(operator_name, chat_id):
                 msg_info = {
                     'id': message.id,
                     'text': message.text,
-                    'date': message.date.isoformat(),
+                    'date': message.date,
                     'sender_id': message.sender_id,
                     'sender_name': getattr(message.sender, 'first_name', '') if message.sender else '',
-                    'is_outgoing': message.out
+                    'is_outgoing': message.out,
+                    'media': describe_media(message, operator_name, account, chat_id)
                 }
                 messages.append(msg_info)
             
             return {'messages': messages}
         
-        result = asyncio.run(_get_messages())
-        return jsonify(result)
+        result = telegram_reads.do(
+            (operator_name, account, 'get_chat_messages', (chat_id, limit)),
+            lambda: JSONSnapshot(run_scheduled(operator_name, account, _get_messages(), priority)),
+            ttl=READ_CACHE_TTL
+        )
+        return json_response(result)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/send_message', methods=['POST'])
 def send_message():
     try:
-        data = request.json
+        upload = request.files.get('file')
+        data = request.form if upload else request.json
         operator = data.get('operator')
         account = data.get('account', 'main')
         chat_id = data.get('chat_id')
         message_text = data.get('message')
         
-        if not all([operator, chat_id, message_text]):
-            return jsonify({'error': 'Все поля обязательны'}), 400
+        if not all([operator, chat_id]) or not (message_text or upload):
+            return json_response({'error': 'Все поля обязательны'}, 400)
+        
+        if upload and str(chat_id).lstrip('-').isdigit():
+            chat_id = int(chat_id)
         
-        async def _send_message():
+        async def _send_message(file_path=None):
             client = await create_client(operator, account)
-            await client.connect()
+            await ensure_connected(client)
             
             if not await client.is_user_authorized():
                 return {'error': 'Пользователь не авторизован'}
             
-            await client.send_message(chat_id, message_text)
+            if file_path:
+                # Telethon читает файл с диска частями, не загружая его целиком в память
+                await client.send_file(
+                    chat_id, file_path,
+                    caption=message_text or '',
+                    part_size_kb=UPLOAD_PART_SIZE_KB
+                )
+            else:
+                await client.send_message(chat_id, message_text)
             return {
                 'success': True,
                 'message': 'Сообщение отправлено'
             }
         
-        result = asyncio.run(_send_message())
-        return jsonify(result)
+        if upload:
+            # Werkzeug держит большие загрузки во временном файле, сохраняем его потоково
+            upload_dir = media_cache.new_temp_dir()
+            try:
+                file_path = os.path.join(upload_dir, secure_filename(upload.filename or '') or 'file')
+                upload.save(file_path)
+                result = run_scheduled(operator, account, _send_message(file_path))
+            finally:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+        else:
+            result = run_scheduled(operator, account, _send_message())
+        # Новое сообщение делает кэшированные диалоги и историю устаревшими
+        telegram_reads.invalidate(operator, account)
+        return json_response(result)
+        
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+@app.route('/api/media/<operator_name>/<int:chat_id>/<int:message_id>')
+def get_media(operator_name, chat_id, message_id):
+    try:
+        account = request.args.get('account', 'main')
+        thumb = request.args.get('thumb') == '1'
+        priority = get_request_priority(PRIORITY_INTERACTIVE if thumb else PRIORITY_BULK)
+        media_key = (operator_name, account, chat_id, message_id, thumb)
+        
+        async def _download_media(download_dir):
+            client = await create_client(operator_name, account)
+            await ensure_connected(client)
+            
+            if not await client.is_user_authorized():
+                return {'error': 'Пользователь не авторизован'}
+            
+            message = await client.get_messages(chat_id, ids=message_id)
+            if not message or not get_media_type(message):
+                return {'error': 'Медиафайл не найден'}
+            
+            thumb_index = None
+            if thumb:
+                thumb_index = 0 if message.photo else -1
+            
+            path = await client.download_media(
+                message, file=os.path.join(download_dir, 'media'), thumb=thumb_index
+            )
+            if not path:
+                return {'error': 'Медиафайл не найден'}
+            
+            return {
+                'path': path,
+                'mime_type': 'image/jpeg' if thumb else message.file.mime_type,
+                'file_name': message.file.name
+            }
+        
+        def _fetch_media():
+            # Хэширование и запись в кэш выполняются вне общего цикла Telegram
+            download_dir = media_cache.new_temp_dir()
+            try:
+                result = run_scheduled(operator_name, account, _download_media(download_dir), priority)
+                if 'error' in result:
+                    return result
+                return media_cache.store(media_key, result['path'], result['mime_type'], result['file_name'])
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
+        
+        # Файл могут вытеснить между lookup и открытием - тогда загружаем заново
+        for attempt in range(2):
+            cached = media_cache.lookup(media_key)
+            if not cached:
+                # Одновременные запросы одного файла ждут одну загрузку
+                cached = telegram_reads.do(
+                    (operator_name, account, 'download_media', (chat_id, message_id, thumb)),
+                    _fetch_media
+                )
+                if 'error' in cached:
+                    return json_response(cached, 404)
+            
+            try:
+                # send_file открывает файл сразу, дальше вытеснение ему не мешает;
+                # conditional=True включает поддержку Range-запросов (206 Partial Content)
+                return send_file(
+                    cached['path'],
+                    mimetype=cached['mime_type'] or 'application/octet-stream',
+                    download_name=None if thumb else cached['file_name'],
+                    conditional=True
+                )
+            except FileNotFoundError:
+                if attempt:
+                    raise
+        
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+@app.route('/api/scheduler_stats')
+def scheduler_stats():
+    try:
+        async def _snapshot():
+            return telegram_scheduler.snapshot()
+        
+        return json_response(run_telegram(_snapshot()))
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/operators')
 def get_operators():
@@ -451,10 +1091,10 @@ def get_operators():
                         'session_file': filename
                     })
         
-        return jsonify({'operators': operators})
+        return json_response({'operators': operators})
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/check_auth/<operator_name>')
 def check_auth(operator_name):
@@ -463,7 +1103,7 @@ def check_auth(operator_name):
         
         async def _check_auth():
             client = await create_client(operator_name, account)
-            await client.connect()
+            await ensure_connected(client)
             
             is_authorized = await client.is_user_authorized()
             return {
@@ -472,11 +1112,11 @@ def check_auth(operator_name):
                 'account': account
             }
         
-        result = asyncio.run(_check_auth())
-        return jsonify(result)
+        result = run_scheduled(operator_name, account, _check_auth())
+        return json_response(result)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/logout/<operator_name>', methods=['POST'])
 def logout_telegram(operator_name):
@@ -485,14 +1125,12 @@ def logout_telegram(operator_name):
         
         async def _logout():
             client = await create_client(operator_name, account)
-            await client.connect()
+            await ensure_connected(client)
             
             await client.log_out()
             
             # Удаляем клиент из памяти
-            client_key = f"{operator_name}_{account}" if account != 'main' else operator_name
-            if client_key in clients:
-                del clients[client_key]
+            clients.pop(get_client_key(operator_name, account), None)
             
             # Удаляем файл сессии
             session_file = get_session_file(operator_name, account)
@@ -504,11 +1142,151 @@ def logout_telegram(operator_name):
                 'message': 'Выход выполнен успешно'
             }
         
-        result = asyncio.run(_logout())
-        return jsonify(result)
+        result = run_scheduled(operator_name, account, _logout())
+        telegram_reads.invalidate(operator_name, account)
+        return json_response(result)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
+
+# Запуск и остановка приложения
+STARTUP_CONNECT_CONCURRENCY = int(os.environ.get('STARTUP_CONNECT_CONCURRENCY', 8))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', 30))
+
+class Lifecycle:
+    """Готовность приложения и учет выполняющихся запросов API"""
+    
+    def __init__(self):
+        self.ready = False
+        self.shutting_down = False
+        self.drained = False
+        self.sessions = {'connected': 0, 'unauthorized': 0, 'failed': 0}
+        self._in_flight = 0
+        self._idle = threading.Condition()
+    
+    @property
+    def in_flight(self):
+        return self._in_flight
+    
+    def request_started(self):
+        with self._idle:
+            self._in_flight += 1
+    
+    def request_finished(self):
+        with self._idle:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.notify_all()
+    
+    def wait_idle(self, timeout):
+        """Дождаться завершения всех запросов; False, если истек таймаут"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._in_flight, timeout)
+
+lifecycle = Lifecycle()
+
+@app.before_request
+def track_api_request():
+    if not request.path.startswith('/api/'):
+        return None
+    if lifecycle.shutting_down:
+        return json_response({'error': 'Сервер останавливается'}, 503)
+    lifecycle.request_started()
+    g.api_request_tracked = True
+
+@app.teardown_request
+def finish_api_request(exc):
+    if g.pop('api_request_tracked', False):
+        lifecycle.request_finished()
+
+@app.route('/healthz')
+def healthz():
+    if lifecycle.shutting_down:
+        status = 'shutting_down'
+    else:
+        status = 'ready' if lifecycle.ready else 'starting'
+    return json_response({
+        'status': status,
+        'sessions': lifecycle.sessions,
+        'clients': len(clients),
+        'in_flight': lifecycle.in_flight
+    }, 200 if status == 'ready' else 503)
+
+async def connect_all_sessions():
+    """Подключить все сохраненные сессии с ограничением параллельности"""
+    sessions_dir = 'sessions'
+    if not API_ID or not API_HASH or not os.path.exists(sessions_dir):
+        return
+    
+    semaphore = asyncio.Semaphore(STARTUP_CONNECT_CONCURRENCY)
+    
+    async def _connect(filename):
+        client_key = filename[:-len('.session')]
+        async with semaphore:
+            client = pool_client(client_key, os.path.join(sessions_dir, filename))
+            try:
+                await ensure_connected(client)
+                if await client.is_user_authorized():
+                    lifecycle.sessions['connected'] += 1
+                else:
+                    # Неавторизованные сессии не держим подключенными
+                    await client.disconnect()
+                    lifecycle.sessions['unauthorized'] += 1
+            except Exception as e:
+                lifecycle.sessions['failed'] += 1
+                print(f"Не удалось подключить сессию {client_key}: {e}")
+    
+    await asyncio.gather(*[
+        _connect(filename) for filename in os.listdir(sessions_dir) if filename.endswith('.session')
+    ])
+
+async def disconnect_all_clients():
+    """Отключить все клиенты пула и сохранить состояние их сессий"""
+    async def _disconnect(client_key, client):
+        try:
+            await client.disconnect()
+            client.session.save()
+        except Exception as e:
+            print(f"Ошибка при отключении клиента {client_key}: {e}")
+    
+    await asyncio.gather(*[_disconnect(key, client) for key, client in list(clients.items())])
+    clients.clear()
+
+def start_telegram():
+    """Подключить сессии в фоне; готовность отражается в /healthz"""
+    future = asyncio.run_coroutine_threadsafe(connect_all_sessions(), telegram_loop)
+    
+    def _done(future):
+        lifecycle.ready = True
+        print(f"Сессии Telegram подключены: {lifecycle.sessions}")
+    
+    future.add_done_callback(_done)
+
+def shutdown(signum=None, frame=None):
+    """Обработчик SIGTERM/SIGINT: запускает остановку, сервер тем временем отвечает 503"""
+    if lifecycle.drained:
+        sys.exit(0)
+    if lifecycle.shutting_down:
+        return
+    lifecycle.shutting_down = True
+    print("Остановка: ждем завершения запросов")
+    threading.Thread(target=drain_and_stop, name='shutdown').start()
+
+def drain_and_stop():
+    """Дождаться запросов и отправок, отключить клиентов Telegram и завершить процесс"""
+    if not lifecycle.wait_idle(SHUTDOWN_DRAIN_TIMEOUT):
+        print(f"Не дождались завершения {lifecycle.in_flight} запросов")
+    
+    try:
+        asyncio.run_coroutine_threadsafe(disconnect_all_clients(), telegram_loop).result(SHUTDOWN_DRAIN_TIMEOUT)
+    except Exception as e:
+        print(f"Ошибка при отключении клиентов Telegram: {e}")
+    telegram_loop.call_soon_threadsafe(telegram_loop.stop)
+    print("Клиенты Telegram отключены, сессии сохранены")
+    
+    # Повторный сигнал обрабатывается в главном потоке и останавливает сервер
+    lifecycle.drained = True
+    os.kill(os.getpid(), signal.SIGTERM)
 
 def create_admin_user():
     """Создание администратора по умолчанию"""
@@ -760,4 +1538,14 @@ if __name__ == '__main__':
         db.create_all()
         create_admin_user()
     
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
+    # Перезагрузчик Werkzeug ставит свой обработчик SIGTERM поверх нашего,
+    # поэтому режим отладки с перезагрузкой включается только через FLASK_DEBUG=1
+    debug = os.environ.get('FLASK_DEBUG') == '1'
+    if not debug:
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+    # С перезагрузчиком клиенты подключаются только в его дочернем процессе
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_telegram()
+    
+    app.run(debug=debug, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
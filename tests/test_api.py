@@ -0,0 +1,109 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+# Окружение задается до импорта приложения: оно читается на уровне модуля
+os.environ.setdefault('TELEGRAM_API_ID', '1')
+os.environ.setdefault('TELEGRAM_API_HASH', 'test')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('MEDIA_CACHE_DIR', tempfile.mkdtemp(prefix='media_cache_'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Glownyi_bot as bot
+
+
+class FakeClient:
+    """Заглушка TelegramClient без сетевых вызовов"""
+
+    def __init__(self, session_file, api_id, api_hash):
+        self.session_file = session_file
+        self.connected = False
+        self.connect_calls = 0
+        self.code_requests = 0
+        self.sign_ins = []
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connect_calls += 1
+        self.connected = True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def iter_dialogs(self):
+        yield SimpleNamespace(
+            id=1,
+            name='Chat',
+            is_channel=False,
+            is_group=False,
+            unread_count=2,
+            message=SimpleNamespace(text='hi', date=datetime(2024, 1, 1, tzinfo=timezone.utc))
+        )
+
+    async def send_code_request(self, phone):
+        self.code_requests += 1
+        return SimpleNamespace(phone_code_hash=f'hash-{self.code_requests}', timeout=None)
+
+    async def sign_in(self, phone=None, code=None, password=None, phone_code_hash=None):
+        self.sign_ins.append((phone, code, phone_code_hash))
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, 'TelegramClient', FakeClient)
+    bot.clients.clear()
+    bot.login_sessions.clear()
+    bot.telegram_reads = bot.SingleFlight()
+    return bot.app.test_client()
+
+
+def test_get_chats_connects_fresh_client_once(client):
+    for _ in range(2):
+        response = client.get('/api/chats/op')
+        assert response.status_code == 200
+        assert response.get_json()['chats'][0]['last_message'] == {
+            'text': 'hi',
+            'date': '2024-01-01T00:00:00+00:00'
+        }
+
+    assert bot.clients['op_main'].connect_calls == 1
+
+
+def test_send_code_deduplicated_within_resend_window(client):
+    payload = {'phone': '+100', 'operator': 'op'}
+    first = client.post('/api/send_code', json=payload).get_json()
+    second = client.post('/api/send_code', json=payload).get_json()
+
+    assert first['phone_code_hash'] == second['phone_code_hash'] == 'hash-1'
+    assert bot.clients['op_main'].code_requests == 1
+
+
+def test_verify_code_uses_server_side_hash(client):
+    client.post('/api/send_code', json={'phone': '+100', 'operator': 'op'})
+    response = client.post('/api/verify_code', json={'phone': '+100', 'code': '12345', 'operator': 'op'})
+
+    assert response.get_json()['success'] is True
+    assert bot.clients['op_main'].sign_ins == [('+100', '12345', 'hash-1')]
+
+
+def test_verify_code_without_send_code_is_rejected(client):
+    response = client.post('/api/verify_code', json={'phone': '+100', 'code': '12345', 'operator': 'op'})
+
+    assert response.status_code == 409
+
+
+def test_verify_code_falls_back_to_client_hash_without_session(client):
+    response = client.post('/api/verify_code', json={
+        'phone': '+100', 'code': '12345', 'operator': 'op', 'phone_code_hash': 'browser-hash'
+    })
+
+    assert response.get_json()['success'] is True
+    assert bot.clients['op_main'].sign_ins == [('+100', '12345', 'browser-hash')]